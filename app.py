@@ -4,54 +4,237 @@ import json
 import logging
 import hmac
 import hashlib
+import threading
+import time
+import queue
 import requests
+from collections import OrderedDict
 from flask import Flask, request
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 
 # Configuração de Logs
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
 logger = logging.getLogger(__name__)
 
 app = Flask(__name__)
+# Limita o corpo das requisições (64 KiB) antes de qualquer parsing de JSON
+app.config['MAX_CONTENT_LENGTH'] = 64 * 1024
+
+# Sessão HTTP compartilhada: reaproveita a conexão TLS com a API do SeaTalk
+SESSION = requests.Session()
+SESSION.headers.update({'Connection': 'keep-alive'})
+# As chamadas ao SeaTalk são POST: só falhas de conexão são repetidas, nunca
+# respostas 5xx (repetir o envio poderia duplicar a mensagem no grupo)
+SESSION.mount('https://', HTTPAdapter(
+    pool_connections=4,
+    pool_maxsize=16,
+    max_retries=Retry(total=2, backoff_factor=0.2)
+))
+
+# Resposta fixa do comando backlog, montada uma única vez
+BACKLOG_MESSAGE = {"tag": "text", "text": {"content": "📋 Robô ativo! Aguardando conexão com a planilha."}}
+
+# Fila de envios ao SeaTalk, consumida por threads fora do ciclo do webhook
+SEND_Q = queue.Queue(maxsize=1024)
+SEND_WORKERS = int(os.environ.get('SEND_WORKERS', '4'))
+
+# Mensagens já tratadas (LRU), para ignorar reenvios do mesmo evento pelo SeaTalk
+_seen_messages = OrderedDict()
+_seen_lock = threading.Lock()
+SEEN_MAX = 1024
+
+# Último comando backlog por grupo (LRU), para ignorar repetições em sequência
+_last_cmd = OrderedDict()
+_last_cmd_lock = threading.Lock()
+BACKLOG_COOLDOWN = float(os.environ.get('BACKLOG_COOLDOWN', '5'))
+COOLDOWN_MAX = 1024
+
+# Credenciais e endpoints do SeaTalk, definidos uma única vez
+SEATALK_APP_ID = os.environ.get('SEATALK_APP_ID')
+SEATALK_APP_SECRET = os.environ.get('SEATALK_APP_SECRET')
+APP_TOKEN_PAYLOAD = {"app_id": SEATALK_APP_ID, "app_secret": SEATALK_APP_SECRET}
+TOKEN_URL = "https://openapi.seatalk.io/auth/app_access_token"
+SEND_URL = "https://openapi.seatalk.io/messaging/v2/group_chat"
+# Códigos de erro da API que indicam app_access_token expirado ou inválido
+SEATALK_AUTH_ERRORS = frozenset({100})
+
+# Cache do token do SeaTalk (válido por ~2h); renovado 60s antes de expirar
+_token_cache = {'token': None, 'exp': 0.0}
+_token_lock = threading.Lock()
+
+# Timer que renova o token em segundo plano ~5min antes de expirar
+_refresh_timer = None
+_refresh_lock = threading.Lock()
 
 def get_seatalk_token():
-    url = "https://openapi.seatalk.io/auth/app_access_token"
-    payload = {"app_id": os.environ.get('SEATALK_APP_ID'), "app_secret": os.environ.get('SEATALK_APP_SECRET')}
+    with _token_lock:
+        if _token_cache['token'] and time.monotonic() < _token_cache['exp'] - 60:
+            return _token_cache['token']
+        return _fetch_seatalk_token()
+
+def _fetch_seatalk_token():
+    # Deve ser chamada com _token_lock adquirido
     try:
-        response = requests.post(url, json=payload, timeout=10)
-        return response.json().get('app_access_token')
+        response = SESSION.post(TOKEN_URL, json=APP_TOKEN_PAYLOAD, timeout=10)
+        body = response.json()
+        token = body.get('app_access_token')
+        # 'expire' vem como timestamp Unix; aceita também segundos restantes
+        expire = int(body.get('expire') or 7200)
     except:
         return None
 
+    if token:
+        ttl = expire - time.time() if expire > 10**9 else expire
+        _token_cache['token'] = token
+        _token_cache['exp'] = time.monotonic() + ttl
+        _schedule_token_refresh(max(60, ttl - 300))
+    return token
+
+def _invalidate_seatalk_token(token):
+    # Só descarta se ninguém já tiver renovado o token nesse meio tempo
+    with _token_lock:
+        if _token_cache['token'] == token:
+            _token_cache['token'] = None
+
+def _schedule_token_refresh(delay):
+    global _refresh_timer
+    with _refresh_lock:
+        if _refresh_timer:
+            _refresh_timer.cancel()
+        _refresh_timer = threading.Timer(delay, _refresh_token_bg)
+        _refresh_timer.daemon = True
+        _refresh_timer.start()
+
+def _refresh_token_bg():
+    with _token_lock:
+        if _fetch_seatalk_token():
+            return
+        logger.warning("Falha ao renovar o token do SeaTalk em segundo plano")
+        # Tenta de novo em 60s enquanto o token atual ainda vale; depois disso,
+        # o próximo comando busca o token normalmente
+        if _token_cache['exp'] - time.monotonic() > 60:
+            _schedule_token_refresh(60)
+
 @app.route('/webhook', methods=['POST'])
 def webhook():
+    # Lê o corpo uma única vez; formulários já ficam em request.form
+    raw = request.get_data(cache=True, parse_form_data=True)
+    try:
+        data = json.loads(raw) if raw else {}
+    except ValueError:
+        data = {}
+    if not isinstance(data, dict):
+        data = {}
+
     # Captura o desafio de qualquer lugar (JSON ou Formulário)
-    data = request.get_json(silent=True) or {}
-    challenge = data.get('seatalk_challenge') or request.form.get('seatalk_challenge')
+    challenge = data.get('seatalk_challenge') if raw else request.form.get('seatalk_challenge')
 
     # --- RESPOSTA AO DESAFIO (Handshake) ---
     # Retorna o texto puro para passar na verificação do SeaTalk
     if challenge:
-        logger.info(f"Verificação aprovada para o desafio: {challenge}")
+        logger.info("Verificação aprovada para o desafio: %s", challenge)
         return str(challenge), 200, {'Content-Type': 'text/plain'}
 
     # --- PROCESSAMENTO DE MENSAGENS REAIS ---
-    if data.get('event_type') == 'new_message':
-        msg_text = data.get('message', {}).get('text', '').strip().lower()
-        group_id = data.get('chat', {}).get('group_id')
-
-        if msg_text == 'backlog':
-            # Aqui você pode adicionar a lógica de leitura da planilha futuramente
-            token = get_seatalk_token()
-            url_send = "https://openapi.seatalk.io/messaging/v2/group_chat"
-            headers = {"Authorization": f"Bearer {token}", "Content-Type": "application/json"}
-            payload_send = {
-                "group_id": group_id, 
-                "message": {"tag": "text", "text": {"content": "📋 Robô ativo! Aguardando conexão com a planilha."}}
-            }
-            requests.post(url_send, headers=headers, json=payload_send, timeout=20)
+    if data.get('event_type') != 'new_message':
+        return "OK", 200
+
+    # A maioria das mensagens não é o comando: descarta pelo tamanho antes de normalizar
+    msg_text = data.get('message', {}).get('text')
+    if not msg_text or len(msg_text) > 16 or msg_text.strip().lower() != 'backlog':
+        return "OK", 200
+
+    group_id = data.get('chat', {}).get('group_id')
+    message_id = data.get('message', {}).get('message_id')
+    seen_key = (group_id, message_id) if message_id else None
+    if seen_key and _already_seen(seen_key):
+        return "OK", 200
+    if _in_cooldown(group_id):
+        logger.debug("Comando backlog ignorado (cooldown) para o grupo %s", group_id)
+        return "OK", 200
 
+    # Responde ao SeaTalk na hora; o envio segue em segundo plano
+    try:
+        SEND_Q.put_nowait((group_id, BACKLOG_MESSAGE))
+    except queue.Full:
+        logger.warning("Fila de envio cheia; comando backlog recusado (grupo %s)", group_id)
+        # Sem 2xx o SeaTalk reenvia o evento; libera a mensagem para que o
+        # reenvio não seja descartado como duplicata
+        if seen_key:
+            _forget_seen(seen_key)
+        # O cooldown só deve contar respostas enfileiradas: desfaz a marca deste
+        # comando para que o reenvio ou um novo "backlog" do grupo não seja ignorado
+        _clear_cooldown(group_id)
+        return "Busy", 503
     return "OK", 200
 
+def _already_seen(key):
+    with _seen_lock:
+        if key in _seen_messages:
+            _seen_messages.move_to_end(key)
+            return True
+        _seen_messages[key] = None
+        if len(_seen_messages) > SEEN_MAX:
+            _seen_messages.popitem(last=False)
+        return False
+
+def _forget_seen(key):
+    with _seen_lock:
+        _seen_messages.pop(key, None)
+
+def _in_cooldown(group_id):
+    now = time.monotonic()
+    with _last_cmd_lock:
+        last = _last_cmd.get(group_id)
+        if last is not None and now - last < BACKLOG_COOLDOWN:
+            return True
+        _last_cmd[group_id] = now
+        _last_cmd.move_to_end(group_id)
+        if len(_last_cmd) > COOLDOWN_MAX:
+            _last_cmd.popitem(last=False)
+        return False
+
+def _clear_cooldown(group_id):
+    with _last_cmd_lock:
+        _last_cmd.pop(group_id, None)
+
+def send_seatalk_message(group_id, message):
+    payload_send = {"group_id": group_id, "message": message}
+    for attempt in range(2):
+        token = get_seatalk_token()
+        if not token:
+            logger.warning("Sem token do SeaTalk; mensagem não enviada (grupo %s)", group_id)
+            return False
+        headers = {"Authorization": f"Bearer {token}", "Content-Type": "application/json"}
+        response = SESSION.post(SEND_URL, headers=headers, json=payload_send, timeout=20)
+        try:
+            code = response.json().get('code')
+        except (ValueError, AttributeError):
+            code = None
+        if response.ok and code == 0:
+            return True
+
+        logger.warning("Falha ao enviar mensagem ao SeaTalk (HTTP %s, code %s)", response.status_code, code)
+        # Token rejeitado (revogado ou substituído por outro worker): renova e tenta mais uma vez
+        if attempt == 0 and (response.status_code == 401 or code in SEATALK_AUTH_ERRORS):
+            _invalidate_seatalk_token(token)
+            continue
+        return False
+
+def _send_worker():
+    while True:
+        group_id, message = SEND_Q.get()
+        try:
+            send_seatalk_message(group_id, message)
+        except Exception:
+            logger.exception("Falha ao enviar mensagem ao SeaTalk")
+        finally:
+            SEND_Q.task_done()
+
+for _ in range(SEND_WORKERS):
+    threading.Thread(target=_send_worker, daemon=True).start()
+
 @app.route('/')
 def index():
     return "Servidor Online - SP5", 200